@@ -2,12 +2,14 @@
 
 import sys, os
 import signal
-from threading import Thread
+from threading import Thread, Lock
 from select import select, epoll, EPOLLPRI
 from functools import partial
 from collections import namedtuple
-from argparse import ArgumentParser
+from argparse import ArgumentParser, SUPPRESS
 import traceback
+import json
+import subprocess
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'))
 
 from dbus.mainloop.glib import DBusGMainLoop
@@ -19,6 +21,8 @@ from settingsdevice import SettingsDevice
 VERSION = '0.31'
 MAXCOUNT = 2**31-1
 SAVEINTERVAL = 60000
+HEALTHINTERVAL = 10000
+RESTARTDELAY = 5000
 
 INPUT_FUNCTION_COUNTER = 1
 INPUT_FUNCTION_INPUT = 2
@@ -245,7 +249,7 @@ class PinHandler(object, metaclass=HandlerMaker):
 
     @product_name.setter
     def product_name(self, v):
-        # Some pin types don't have an associated service (Disabled pins for
+        # Some pin types don't have an associated service (TouchEnable pins for
         # example)
         if self.service is not None:
             self.service['/ProductName'] = v or self._product_name
@@ -286,6 +290,14 @@ class PinHandler(object, metaclass=HandlerMaker):
     def active(self):
         return self.service is not None
 
+    @property
+    def summary(self):
+        """ State, count and alarm of this input, as published on the
+            control service. """
+        if self.service is None:
+            return None, None, None
+        return None, self.count, None
+
     @property
     def count(self):
         return self.service['/Count']
@@ -332,10 +344,39 @@ class NopPin(object):
         pass
 
 
-class DisabledPin(NopPin, PinHandler):
-    """ Place holder for a disabled pin. """
-    _product_name = 'Disabled'
-    type_id = 0
+class DisabledPin(object):
+    """ Place holder for a disabled pin. On systems with IO extenders most
+        inputs are disabled, so this is kept as small as possible, and holds
+        no bus connection. """
+    __slots__ = ('settings',)
+    bus = None
+    service = None
+    active = False
+    summary = (None, None, None)
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    @property
+    def product_name(self):
+        return self.settings['name'] or 'Disabled'
+
+    @product_name.setter
+    def product_name(self, v):
+        pass
+
+    @property
+    def count(self):
+        return self.settings['count']
+
+    def refresh(self):
+        pass
+
+    def deactivate(self):
+        pass
+
+    def save_count(self):
+        pass
 
 
 class VolumeCounter(PinHandler):
@@ -419,6 +460,12 @@ class PinAlarm(PinHandler):
             # disappears.
             s['/Alarm'] = self.get_alarm_state(level)
 
+    @property
+    def summary(self):
+        if self.service is None:
+            return None, None, None
+        return self.service['/State'], self.count, self.service['/Alarm']
+
     def get_state(self, level):
         state = level ^ self.settings['InvertTranslation']
         return 2 * self.translation + state
@@ -551,6 +598,290 @@ def parse_config(conf):
 
     return pins
 
+class Pipe(object):
+    """ Line based exchange of json messages over a pair of pipe file
+        descriptors, driven from the main loop. Writes don't block, output
+        the other side isn't ready for is kept until it is. """
+    def __init__(self, rfd, wfd, callback):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.callback = callback
+        self._buf = b''
+        self._out = b''
+        self._batch = None
+        self._outwatch = None
+        os.set_blocking(wfd, False)
+        self._watch = GLib.io_add_watch(rfd, GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP, self._read)
+
+    def send(self, *msg):
+        line = json.dumps(msg).encode('utf-8') + b'\n'
+        if self._batch is not None:
+            self._batch.append(line)
+        else:
+            self._write(line)
+
+    def __enter__(self):
+        self._batch = []
+        return self
+
+    def __exit__(self, *exc):
+        batch, self._batch = self._batch, None
+        if batch:
+            self._write(b''.join(batch))
+
+    def _write(self, data):
+        self._out += data
+        if self._outwatch is None:
+            self._flush()
+
+    def _flush(self, *args):
+        try:
+            while self._out:
+                n = os.write(self.wfd, self._out)
+                self._out = self._out[n:]
+        except BlockingIOError:
+            # Try again once the other side has read some
+            if self._outwatch is None:
+                self._outwatch = GLib.io_add_watch(self.wfd,
+                    GLib.PRIORITY_DEFAULT, GLib.IO_OUT, self._flush)
+            return True
+        except OSError:
+            # The other side went away, this is handled on the read side
+            self._out = b''
+
+        self._outwatch = None
+        return False
+
+    def _read(self, fd, condition):
+        data = os.read(fd, 4096) if condition & GLib.IO_IN else b''
+        if not data:
+            self._watch = None
+            self.callback(None)
+            return False
+        self._buf += data
+        *lines, self._buf = self._buf.split(b'\n')
+        msgs = []
+        for l in lines:
+            try:
+                msgs.append(json.loads(l))
+            except ValueError:
+                print ("Ignoring malformed message {!r}".format(l))
+        self.callback(msgs)
+        return True
+
+    def close(self):
+        for watch in (self._watch, self._outwatch):
+            if watch is not None:
+                GLib.source_remove(watch)
+        self._watch = self._outwatch = None
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+class WorkerControl(object):
+    """ Stands in for the control service in a worker process. Paths are
+        forwarded to the supervisor, which publishes them on the real control
+        service, and writes to those paths are passed back. """
+    def __init__(self, rfd, wfd, mainloop):
+        self.mainloop = mainloop
+        self.values = {}
+        self.callbacks = {}
+        self.pipe = Pipe(rfd, wfd, self._received)
+
+    def add_path(self, path, value, writeable=False, onchangecallback=None):
+        self.values[path] = value
+        self.callbacks[path] = onchangecallback
+        self.pipe.send('add', path, value, writeable)
+
+    def __getitem__(self, path):
+        return self.values[path]
+
+    def __setitem__(self, path, value):
+        self.values[path] = value
+        self.pipe.send('set', path, value)
+
+    def __enter__(self):
+        self.pipe.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.pipe.__exit__(*exc)
+
+    def health(self, pulses):
+        t = os.times()
+        self.pipe.send('health', pulses, round(t.user + t.system, 2))
+
+    def _received(self, msgs):
+        # The supervisor went away, so should we.
+        if msgs is None:
+            self.mainloop.quit()
+            return
+
+        for cmd, path, value in msgs:
+            cb = self.callbacks.get(path)
+            if cmd == 'set' and cb is not None and cb(path, value):
+                self.values[path] = value
+            elif path in self.values:
+                # Rejected, restore the value on the supervisor
+                self[path] = self.values[path]
+
+class Worker(object):
+    """ A worker process handling one group of inputs. """
+    def __init__(self, index, args, group, name):
+        self.index = index
+        self.args = args
+        self.group = group
+        self.name = name
+        self.proc = None
+        self.pipe = None
+        self.paths = set()
+        self.restarts = -1
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    def start(self, received, exited):
+        rfd, child_wfd = os.pipe()
+        child_rfd, wfd = os.pipe()
+        cmd = [sys.executable, '-u', os.path.abspath(__file__),
+            '--servicebase', self.args.servicebase,
+            '--poll', self.args.poll,
+            '--worker', '{},{}'.format(child_rfd, child_wfd)] + self.group
+        self.proc = subprocess.Popen(cmd, pass_fds=(child_rfd, child_wfd))
+        os.close(child_rfd)
+        os.close(child_wfd)
+        self.pipe = Pipe(rfd, wfd, partial(received, self))
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.proc.pid,
+            lambda pid, status: exited(self, status))
+        self.restarts += 1
+
+    def stop(self):
+        if self.running:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+def supervise(args):
+    """ Run each group of inputs in its own worker process. The built-in
+        inputs form one group, and each config file another. This process
+        owns the control service and restarts workers that die. """
+    DBusGMainLoop(set_as_default=True)
+
+    ctlbus = dbusconnection()
+    ctlsvc = VeDbusService(args.servicebase + '.digitalinputs', bus=ctlbus, register=True)
+
+    groups = [(['--conf', c], c) for c in args.conf]
+    if args.inputs:
+        groups.insert(0, (args.inputs, ' '.join(args.inputs)))
+
+    workers = [Worker(i, args, g, n) for i, (g, n) in enumerate(groups)]
+
+    # The worker responsible for each published path
+    owners = {}
+
+    # Selecting a generator disables the built-in inputs configured as
+    # generator, as it does without workers. The built-in worker does this
+    # for its own inputs, for the others it is done here. Type paths of
+    # built-in generators are tracked as reported, and dropped as soon as
+    # they are told to disable.
+    builtin = workers[0] if args.inputs else None
+    generators = set()
+
+    def type_changed(worker, path, value):
+        if worker is builtin:
+            if value == 9:
+                generators.add(path)
+            else:
+                generators.discard(path)
+        elif value == 9 and builtin is not None and builtin.running:
+            for p in generators:
+                builtin.pipe.send('set', p, 0)
+            generators.clear()
+
+    def forward(worker, path, value):
+        # Writes are refused while the worker is restarting
+        if not worker.running:
+            return False
+        if path.endswith('/Type') and not 0 <= value < len(INPUTTYPES):
+            return False
+        worker.pipe.send('set', path, value)
+        return True
+
+    def received(worker, msgs):
+        if msgs is None:
+            return # Handled when the process exits
+        with ctlsvc as s:
+            for msg in msgs:
+                cmd = msg[0]
+                if cmd == 'add':
+                    path, value, writeable = msg[1:]
+                    worker.paths.add(path)
+                    if path in owners:
+                        s[path] = value
+                    else:
+                        s.add_path(path, value, writeable=writeable,
+                            onchangecallback=partial(forward, worker))
+                    owners[path] = worker
+
+                    # Only track what is configured at startup, stored
+                    # settings are left as they are.
+                    if worker is builtin and path.endswith('/Type'):
+                        type_changed(worker, path, value)
+                elif cmd == 'set':
+                    path, value = msg[1:]
+                    s[path] = value
+                    if path.endswith('/Type'):
+                        type_changed(worker, path, value)
+                elif cmd == 'health':
+                    s['/Workers/{}/Pulses'.format(worker.index)] = msg[1]
+                    s['/Workers/{}/CpuTime'.format(worker.index)] = msg[2]
+
+    def start(worker):
+        worker.start(received, exited)
+        ctlsvc['/Workers/{}/Pid'.format(worker.index)] = worker.proc.pid
+        ctlsvc['/Workers/{}/Restarts'.format(worker.index)] = worker.restarts
+        return False
+
+    def exited(worker, status):
+        print ("Worker {} exited with status {}, restarting".format(
+            worker.index, status))
+        # The child watch reaped the process. Tell Popen, so that it doesn't
+        # try to reap the pid later, when it may belong to another process.
+        worker.proc.returncode = os.waitstatus_to_exitcode(status)
+        worker.pipe.close()
+        with ctlsvc as s:
+            s['/Workers/{}/Pid'.format(worker.index)] = None
+            # Input states are unknown until the worker is back
+            for path in worker.paths:
+                if path.rsplit('/', 1)[1] in ('State', 'Count', 'Alarm'):
+                    s[path] = None
+        GLib.timeout_add(RESTARTDELAY, start, worker)
+
+    for w in workers:
+        prefix = '/Workers/{}'.format(w.index)
+        ctlsvc.add_path(prefix + '/Group', w.name)
+        ctlsvc.add_path(prefix + '/Pid', None)
+        ctlsvc.add_path(prefix + '/Restarts', 0)
+        ctlsvc.add_path(prefix + '/Pulses', None)
+        ctlsvc.add_path(prefix + '/CpuTime', None)
+        start(w)
+
+    mainloop = GLib.MainLoop()
+
+    # Stop the workers on shutdown, so they save their counters
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in workers:
+            w.stop()
+
 def main():
     parser = ArgumentParser(description=sys.argv[0])
     parser.add_argument('--servicebase',
@@ -560,42 +891,118 @@ def main():
         help='Use a different kind of polling. Options are epoll, dumb and debug',
         default='epoll')
     parser.add_argument('--conf', action='append', default=[], help='Config file')
+    parser.add_argument('--shard', action='store_true',
+        help='Run the built-in inputs, and the inputs of each config file, in separate processes')
+    parser.add_argument('--worker', help=SUPPRESS)
     parser.add_argument('inputs', nargs='*', help='Path to digital input')
     args = parser.parse_args()
 
+    if args.shard:
+        return supervise(args)
+
     PulseCounter = {
         'debug': DebugPulseCounter,
         'poll': PollingPulseCounter,
     }.get(args.poll, EpollPulseCounter)
 
     DBusGMainLoop(set_as_default=True)
+    mainloop = GLib.MainLoop()
 
     ctlbus = dbusconnection()
-    ctlsvc = VeDbusService(args.servicebase + '.digitalinputs', bus=ctlbus, register=True)
+    if args.worker:
+        rfd, wfd = (int(fd) for fd in args.worker.split(','))
+        ctlsvc = WorkerControl(rfd, wfd, mainloop)
+    else:
+        ctlsvc = VeDbusService(args.servicebase + '.digitalinputs', bus=ctlbus, register=True)
+
+    # Number of edges handled, reported to the supervisor
+    health = {'pulses': 0}
 
     # Keep track of enabled services
     services = {}
     inputs = dict(enumerate(args.inputs, 1))
     pulses = PulseCounter() # callable that iterates over pulses
 
+    # Built-in inputs currently configured as generator. Selecting a
+    # generator disables these, so only one is active at a time.
+    generators = set()
+
+    # Setting changes that only require the service to be refreshed are
+    # collected here, keyed by input, and applied from an idle callback. A
+    # settings restore then causes a single refresh per input rather than
+    # one for every changed setting.
+    pending = {}
+
+    # Inputs whose state must be republished on the control service. The
+    # poller thread adds to this, the main loop publishes all changes from
+    # one iteration in a single ItemsChanged signal.
+    changed = set()
+    changed_lock = Lock()
+
+    def publish_changes():
+        with changed_lock:
+            inps = list(changed)
+            changed.clear()
+        with ctlsvc as s:
+            for inp in inps:
+                state, count, alarm = services[inp].summary
+                s['/Devices/{}/State'.format(inp)] = state
+                s['/Devices/{}/Count'.format(inp)] = count
+                s['/Devices/{}/Alarm'.format(inp)] = alarm
+        return False
+
+    def input_changed(inp):
+        with changed_lock:
+            if not changed:
+                GLib.idle_add(publish_changes)
+            changed.add(inp)
+
     def register_gpio(path, gpio, bus, settings):
         _type = settings['inputtype']
         print ("Registering GPIO {} for type {}".format(gpio, _type))
 
-        handler = PinHandler.createHandler(_type,
-            bus, args.servicebase, path, gpio, settings)
-        services[gpio] = handler
-
-        # Only monitor if enabled
+        # Disabled pins get a light-weight placeholder, and are not monitored.
+        # Enabled pins need a bus connection of their own for their service.
         if _type > 0:
+            handler = PinHandler.createHandler(_type,
+                bus or dbusconnection(), args.servicebase, path, gpio, settings)
+            services[gpio] = handler
             handler.level = pulses.register(path, gpio)
             handler.refresh()
+        else:
+            services[gpio] = DisabledPin(settings)
+
+        input_changed(gpio)
 
     def unregister_gpio(gpio):
         print ("unRegistering GPIO {}".format(gpio))
         if pulses.registered(gpio):
             pulses.unregister(gpio)
             services[gpio].deactivate()
+            input_changed(gpio)
+
+    def apply_pending():
+        while pending:
+            inp, changes = pending.popitem()
+            handler = services[inp]
+            if not handler.active:
+                continue
+            with handler.service as s:
+                for setting, v in changes.items():
+                    try:
+                        s[f'/Settings/{setting}'] = v
+                    except KeyError:
+                        pass # Some settings are not on all services
+            handler.refresh()
+            input_changed(inp)
+        return False
+
+    def defer_refresh(inp, setting=None, value=None):
+        if not pending:
+            GLib.idle_add(apply_pending)
+        changes = pending.setdefault(inp, {})
+        if setting is not None:
+            changes[setting] = value
 
     def handle_setting_change(pin, setting, old, new):
         # This handler may also be called if some attribute of a setting
@@ -606,6 +1013,9 @@ def main():
         inp = pin.name
 
         if setting == 'inputtype':
+            # The service is recreated below, anything pending is stale.
+            pending.pop(inp, None)
+
             if new:
                 # Get current bus and settings objects, to be reused
                 service = services[inp]
@@ -616,10 +1026,11 @@ def main():
                     unregister_gpio(inp)
 
                 # We only want 1 generator input at a time, so disable other inputs configured as generator.
-                for i in inputs:
-                    if i != inp and services[i].settings['inputtype'] == 9 == new:
+                if new == 9:
+                    for i in generators - {inp}:
                         services[i].settings['inputtype'] = 0
                         unregister_gpio(i)
+                        generators.discard(i)
 
                 # Before registering the new input, reset its settings to defaults
                 settings['count'] = 0
@@ -630,16 +1041,24 @@ def main():
                 # Register it
                 register_gpio(pin.path, inp, bus, settings)
             elif old:
-                # Input disabled
+                # Input disabled. Drop its bus connection, a new one is
+                # opened if it is enabled again.
                 unregister_gpio(inp)
+                handler = services[inp]
+                services[inp] = DisabledPin(handler.settings)
+                if handler.bus is not None:
+                    # Deactivating may have queued calls, send them first
+                    handler.bus.flush()
+                    handler.bus.close()
+
+            if new == 9 and inp in inputs:
+                generators.add(inp)
+            else:
+                generators.discard(inp)
 
             ctlsvc['/Devices/{}/Type'.format(inp)] = new
         elif setting in ('InvertTranslation', 'AlarmSetting', 'InvertAlarm', 'Multiplier'):
-            try:
-                services[inp].service[f'/Settings/{setting}'] = new
-            except KeyError:
-                pass # Some settings are not on all services
-            services[inp].refresh()
+            defer_refresh(inp, setting, new)
         elif setting == 'name':
             services[inp].product_name = new
         elif setting == 'count':
@@ -647,9 +1066,14 @@ def main():
             # if it has changed.
             v = int(new)
             s = services[inp]
-            if s.active and s.count != v:
-                s.count = v
-                s.refresh()
+            if s.active:
+                if s.count != v:
+                    s.count = v
+                    defer_refresh(inp)
+                # A write to /Count on the input's own service already
+                # updated it, but the control service may not know yet.
+                if ctlsvc['/Devices/{}/Count'.format(inp)] != v:
+                    input_changed(inp)
 
     def change_type(sd, path, val):
         if not 0 <= val < len(INPUTTYPES):
@@ -682,12 +1106,19 @@ def main():
             'name': ['/Settings/DigitalInput/{}/CustomName'.format(inp), '', '', ''],
             'instance': ['/Settings/Devices/{}/ClassAndVrmInstance'.format(devid), inst, '', ''],
         }
-        bus = dbusconnection()
-        sd = SettingsDevice(bus, supported_settings, partial(handle_setting_change, pin), timeout=10)
-        register_gpio(pin.path, inp, bus, sd)
+        # Settings share the control connection, a dedicated connection is
+        # only opened once the input is enabled.
+        sd = SettingsDevice(ctlbus, supported_settings, partial(handle_setting_change, pin), timeout=10)
+        register_gpio(pin.path, inp, None, sd)
+        if sd['inputtype'] == 9 and inp in inputs:
+            generators.add(inp)
         ctlsvc.add_path('/Devices/{}/Label'.format(inp), pin.label)
         ctlsvc.add_path('/Devices/{}/Type'.format(inp), sd['inputtype'],
                         writeable=True, onchangecallback=partial(change_type, sd))
+        state, count, alarm = services[inp].summary
+        ctlsvc.add_path('/Devices/{}/State'.format(inp), state)
+        ctlsvc.add_path('/Devices/{}/Count'.format(inp), count)
+        ctlsvc.add_path('/Devices/{}/Alarm'.format(inp), alarm)
 
     def poll(mainloop):
         from time import time
@@ -696,19 +1127,20 @@ def main():
         try:
             for inp, level in pulses():
                 # epoll object only resyncs once a second. We may receive
-                # a pulse for something that's been deregistered.
+                # a pulse for something that's been deregistered, or
+                # that has since been replaced by a DisabledPin.
                 try:
                     services[inp].toggle(level)
-                except KeyError:
+                except (KeyError, AttributeError):
                     continue
+                health['pulses'] += 1
+                input_changed(inp)
         except:
             traceback.print_exc()
             mainloop.quit()
 
     # Need to run the gpio polling in separate thread. Pass in the mainloop so
     # the thread can kill us if there is an exception.
-    mainloop = GLib.MainLoop()
-
     poller = Thread(target=lambda: poll(mainloop))
     poller.daemon = True
     poller.start()
@@ -720,6 +1152,10 @@ def main():
         return True
     GLib.timeout_add(SAVEINTERVAL, save_counters)
 
+    if args.worker:
+        GLib.timeout_add(HEALTHINTERVAL,
+            lambda: ctlsvc.health(health['pulses']) or True)
+
     # Save counter on shutdown
     signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
 